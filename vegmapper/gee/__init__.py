@@ -1,3 +1,3 @@
-from .gee_download_files import download_files
+from .gee_download_files import download_files, split_blocks
 from .gee_export_landsat_ndvi import export_landsat_ndvi
 from .gee_export_modis_tc import export_modis_tc
@@ -1,4 +1,5 @@
 import json
+import subprocess
 
 from vegmapper import pathurl
 from vegmapper.pathurl import PathURL
@@ -37,3 +38,19 @@ def download_files(data_dir, tasks):
             dst_dir = data_dir
             print(f'Downloading {filename}')
             pathurl.copy(gcs_url, dst_dir, overwrite=True)
+
+
+def split_blocks(data_dir, blocks):
+    # Cut downloaded block exports back into one GeoTIFF per tile
+    if not isinstance(blocks, dict):
+        with open(blocks) as f:
+            blocks = json.load(f)
+    for block_name, block_tiles in blocks.items():
+        block_tif = f'{data_dir}/{block_name}.tif'
+        for tile_name, (xmin, ymin, xmax, ymax) in block_tiles.items():
+            print(f'Extracting {tile_name} from {block_name}')
+            cmd = (f'gdal_translate -q '
+                   f'-projwin {xmin} {ymax} {xmax} {ymin} '
+                   f'-co COMPRESS=LZW '
+                   f'{block_tif} {data_dir}/{tile_name}.tif')
+            subprocess.check_call(cmd, shell=True)
@@ -2,10 +2,12 @@
 
 import argparse
 import json
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import ee
 import geopandas as gpd
+import numpy as np
 
 from vegmapper import pathurl
 from vegmapper.pathurl import ProjDir
@@ -31,73 +33,122 @@ def addNDVI(image):
     return image.addBands(ndvi)
 
 
-def export_landsat_ndvi(proj_dir, sitename, tiles, res, year, gs=None):
+def export_landsat_ndvi(proj_dir, sitename, tiles, res, year, gs=None, block_size=1):
+    """
+    Submit GEE export tasks of Landsat NDVI for the tiles with mask == 1.
+
+    With block_size > 1, tiles are grouped into blocks of block_size x block_size
+    (by h and v) and each block is exported as a single image, which amortizes
+    the per-task overhead of GEE. The tiles covered by each block are saved to
+    export_blocks.json so the downloaded blocks can be cut back into tiles with
+    gee.split_blocks.
+    """
+    if not isinstance(block_size, int) or block_size < 1:
+        raise ValueError(f'block_size must be a positive integer, got {block_size!r}')
+
     print(f'\nSubmitting GEE jobs for exporting Landsat NDVI ...')
 
-    gdf_tiles = gpd.read_file(tiles)
+    gdf_tiles = gpd.read_file(tiles, engine='pyogrio')
     epsg = gdf_tiles.crs.to_epsg()
+
+    # Only tiles with mask == 1 are exported
+    n_tiles = len(gdf_tiles)
+    gdf_tiles = gdf_tiles[gdf_tiles['mask'] == 1].reset_index(drop=True)
+    print(f'{n_tiles - len(gdf_tiles)} of {n_tiles} tiles skipped (mask == 0)')
     gdf_wgs84 = gdf_tiles.to_crs('epsg:4326')
 
     ee.Initialize()
 
-    # Export data for each tile
+    # Group tiles into export regions
+    regions = {}
+    for i, (h, v) in enumerate(zip(gdf_tiles['h'], gdf_tiles['v'])):
+        regions.setdefault((h // block_size, v // block_size), []).append(i)
+
+    # Bounds of all tiles, then of each region, computed once as arrays
+    bounds_arr = gdf_tiles.bounds.to_numpy()
+    bounds_wgs84 = gdf_wgs84.bounds.to_numpy()
+
+    def region_bounds(bounds, idx):
+        b = bounds[idx]
+        return np.concatenate([b[:, :2].min(axis=0), b[:, 2:].max(axis=0)])
+
+    region_arr = np.array([region_bounds(bounds_arr, idx) for idx in regions.values()]).reshape(-1, 4)
+    xmin, ymin, xmax, ymax = region_arr.T
+    xdim = ((xmax - xmin) / res).astype(int)
+    ydim = ((ymax - ymin) / res).astype(int)
+
+    # GEE splits large exports into shards unless fileDimensions covers the whole image;
+    # it must be a multiple of the shard size (256)
+    shard_size = 256
+    xfile = -(-xdim // shard_size) * shard_size
+    yfile = -(-ydim // shard_size) * shard_size
+
+    epsg_str = f'EPSG:{epsg}'
+    if gs is not None:
+        gs = pathurl.PathURL(gs)
+        if gs.storage != 'gs':
+            raise Exception('Currently GEE only supports exporting data to Google Storage buckets (gs://).')
+
+    # Export data for each region
     task_list = []
-    for i in gdf_tiles.index:
-        h = gdf_tiles['h'][i]
-        v = gdf_tiles['v'][i]
-        m = gdf_tiles['mask'][i]
-        g = gdf_tiles['geometry'][i]
-        xmin = g.bounds[0]
-        ymin = g.bounds[1]
-        xmax = g.bounds[2]
-        ymax = g.bounds[3]
-        xdim = int((xmax - xmin) / res)
-        ydim = int((ymax - ymin) / res)
-
+    export_blocks = {}
+    for r, ((bh, bv), idx) in enumerate(regions.items()):
         # Native crsTransform of Landsat data (pixel center coordinates are multiples of res)
-        ct_0 = [res, 0, xmin-res/2, 0, -res, ymax+res/2]
+        ct_0 = [res, 0, xmin[r]-res/2, 0, -res, ymax[r]+res/2]
 
         # Preferred crsTransform (pixel corner coordinates are multiples of res)
-        ct_1 = [res, 0, xmin, 0, -res, ymax]
-
-        if m == 1:
-            # Get cloud-masked SR median
-            tile = ee.Geometry.Rectangle(gdf_wgs84['geometry'][i].bounds)
-            sr = ee.ImageCollection('LANDSAT/LC08/C02/T1_L2').filterDate(f'{year}-01-01', f'{year}-12-31').map(maskL8sr).filterBounds(tile).median()
-
-            # Set crs and crsTransform to the native ones and use bilinear interpolation when exported
-            ndvi = addNDVI(sr).select('NDVI').reproject(**{'crs': f'EPSG:{epsg}', 'crsTransform': ct_0}).resample('bilinear')
-
-            if gs is not None:
-                gs = pathurl.PathURL(gs)
-                if gs.storage != 'gs':
-                    raise Exception('Currently GEE only supports exporting data to Google Storage buckets (gs://).')
-                # Export data to Google Storage bucket
-                task = ee.batch.Export.image.toCloudStorage(
-                    bucket=gs.bucket,
-                    fileNamePrefix=f'{gs.prefix}/landsat_ndvi_{sitename}_{year}_h{h}v{v}',
-                    image=ndvi,
-                    description=f'landsat_ndvi_{sitename}_{year}_h{h}v{v}',
-                    dimensions=f'{xdim}x{ydim}',
-                    maxPixels=1e9,
-                    crs=f'EPSG:{epsg}',
-                    crsTransform=ct_1
-                )
-            else:
-                task = ee.batch.Export.image.toDrive(
-                    image=ndvi,
-                    description=f'landsat_ndvi_{sitename}_{year}_h{h}v{v}',
-                    dimensions=f'{xdim}x{ydim}',
-                    maxPixels=1e9,
-                    crs=f'EPSG:{epsg}',
-                    crsTransform=ct_1
-                )
-            task.start()
-            task_list.append(task)
-
-            print(f'#{i+1}: h{h}v{v} started')
+        ct_1 = [res, 0, xmin[r], 0, -res, ymax[r]]
+
+        tile_names = [f"landsat_ndvi_{sitename}_{year}_h{gdf_tiles['h'][i]}v{gdf_tiles['v'][i]}" for i in idx]
+        if block_size == 1:
+            name = tile_names[0]
+        else:
+            name = f'landsat_ndvi_{sitename}_{year}_block{bh}-{bv}'
+            export_blocks[name] = {
+                tile_name: bounds_arr[i].tolist() for tile_name, i in zip(tile_names, idx)
+            }
+
+        # Get cloud-masked SR median
+        tile = ee.Geometry.Rectangle(region_bounds(bounds_wgs84, idx).tolist())
+        sr = ee.ImageCollection('LANDSAT/LC08/C02/T1_L2').filterDate(f'{year}-01-01', f'{year}-12-31').map(maskL8sr).filterBounds(tile).median()
+
+        # Set crs and crsTransform to the native ones and use bilinear interpolation when exported
+        ndvi = addNDVI(sr).select('NDVI').reproject(**{'crs': epsg_str, 'crsTransform': ct_0}).resample('bilinear')
+
+        if gs is not None:
+            # Export data to Google Storage bucket
+            task = ee.batch.Export.image.toCloudStorage(
+                bucket=gs.bucket,
+                fileNamePrefix=f'{gs.prefix}/{name}',
+                image=ndvi,
+                description=name,
+                dimensions=f'{xdim[r]}x{ydim[r]}',
+                maxPixels=1e9 * len(idx),
+                shardSize=shard_size,
+                fileDimensions=[int(xfile[r]), int(yfile[r])],
+                crs=epsg_str,
+                crsTransform=ct_1
+            )
         else:
-            print(f'#{i+1}: h{h}v{v} skipped')
+            task = ee.batch.Export.image.toDrive(
+                image=ndvi,
+                description=name,
+                dimensions=f'{xdim[r]}x{ydim[r]}',
+                maxPixels=1e9 * len(idx),
+                shardSize=shard_size,
+                fileDimensions=[int(xfile[r]), int(yfile[r])],
+                crs=epsg_str,
+                crsTransform=ct_1
+            )
+        task_list.append(task)
+
+    # Start tasks concurrently, each start is a blocking request to the GEE API
+    def start_task(task):
+        task.start()
+        print(f"{task.config['description']} started")
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        list(executor.map(start_task, task_list))
 
     # Save export destinations
     proj_dir = ProjDir(proj_dir)
@@ -109,6 +160,9 @@ def export_landsat_ndvi(proj_dir, sitename, tiles, res, year, gs=None):
             export_dst_json.parent.mkdir(parents=True)
         with open(export_dst_json, 'w') as f:
             json.dump(export_dst, f)
+        if export_blocks:
+            with open(export_dst_json.parent / 'export_blocks.json', 'w') as f:
+                json.dump(export_blocks, f)
 
     return task_list
 
@@ -117,6 +171,9 @@ def main():
     parser = argparse.ArgumentParser(
         description='submit GEE processing for Landsat NDVI'
     )
+    parser.add_argument('proj_dir', metavar='proj_dir',
+                        type=str,
+                        help='project directory (local path or cloud bucket URL)')
     parser.add_argument('sitename', metavar='sitename',
                         type=str,
                         help='site name')
@@ -130,9 +187,12 @@ def main():
     parser.add_argument('year', metavar='year',
                         type=int,
                         help='year of dataset')
+    parser.add_argument('--block_size',
+                        type=int, default=1,
+                        help='number of tiles along h and v exported together as one image')
     args = parser.parse_args()
 
-    export_landsat_ndvi(args.sitename, args.tiles, args.res, args.year)
+    export_landsat_ndvi(args.proj_dir, args.sitename, args.tiles, args.res, args.year, block_size=args.block_size)
 
 
 if __name__ == '__main__':
@@ -1,16 +1,27 @@
 #!/usr/bin/env python
 
 import os
-import shutil
+import functools
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import geopandas as gpd
 from osgeo import gdal
 import rasterio
-from rasterio.crs import CRS
-import tempfile
-import subprocess
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import warnings
 
+# In-memory reprojected VRTs already created by this worker process
+_created_files = set()
+
+
+def _init_worker():
+    # Raise on GDAL errors in the workers, as the gdal CLI calls did with check=True.
+    # Enabled here rather than at import so other users of vegmapper.s1 are unaffected.
+    gdal.UseExceptions()
+
+
 def map_burst2tile(reference_tiles, burst_summary_gdf, rtc_dir):
     """
     This function reads the reference tiles
@@ -24,49 +35,60 @@ def map_burst2tile(reference_tiles, burst_summary_gdf, rtc_dir):
     """
     
     # Load the GeoJSON file into a GeoDataFrame
-    tile_gdf = gpd.read_file(reference_tiles)
+    tile_gdf = gpd.read_file(reference_tiles, engine='pyogrio')
     burst_gdf = burst_summary_gdf.copy()
     # extract target crs from tiles
     tile_crs = tile_gdf.crs
     tile_epsg_number = tile_crs.to_string().split(':')[-1]
     # set burst crs
     burst_gdf.set_crs(epsg=4326, inplace=True) # This epsg is hard coded because its expected to be always the same.
+    # Drop bursts outside the tiles extent (with a small margin) before reprojecting them
+    margin = 0.1  # degrees
+    minx, miny, maxx, maxy = tile_gdf.to_crs(epsg=4326).total_bounds
+    burst_gdf = burst_gdf.cx[minx - margin:maxx + margin, miny - margin:maxy + margin]
     # Ensure both GeoDataFrames have the same CRS before overlapping
     tile_gdf = tile_gdf.to_crs(epsg=tile_epsg_number)
     burst_gdf = burst_gdf.to_crs(epsg=tile_epsg_number)
     
-    # Perform spatial join to find overlapping geometries
-    overlapping_gdf = gpd.sjoin(burst_gdf, tile_gdf, how="inner", predicate="intersects")
+    # Query the burst spatial index with the tiles to find overlapping geometries
+    tile_pos, burst_pos = burst_gdf.sindex.query(tile_gdf.geometry, predicate="intersects")
+    # Keep bursts in their original order within each tile, as sjoin did
+    order = np.lexsort((burst_pos, tile_pos))
+    tile_pos, burst_pos = tile_pos[order], burst_pos[order]
+
+    # Collect overlapping burst ids for each tile
+    tile_labels = tile_gdf.index.to_numpy()
+    burst_ids = burst_gdf['burst_id'].to_numpy()
+    # Pairs are sorted by tile, so each tile's bursts form a contiguous run
+    uniq_tiles, starts = np.unique(tile_pos, return_index=True)
+    groups = np.split(burst_ids[burst_pos], starts[1:])
+    overlap_dict = dict(zip(tile_labels[uniq_tiles].tolist(), (group.tolist() for group in groups)))
     
-    # Group by the index of geojson_gdf to collect overlapping 'names'
-    overlap_dict = overlapping_gdf.groupby('index_right')['burst_id'].apply(list).to_dict()
-    
-    # Add the overlapping names back to the GeoJSON GeoDataFrame
-    tile_gdf['overlapping_bursts'] = tile_gdf.index.map(overlap_dict)
-
-    # Export geodataframe as geojson
-    def join_lists(cell):
-        if isinstance(cell, list):
-            return ','.join(cell)
-        return cell
+    # Add the overlapping names back to the GeoJSON GeoDataFrame as an Arrow list column
+    tile_gdf['overlapping_bursts'] = pd.array(
+        [overlap_dict.get(label) for label in tile_gdf.index],
+        dtype=pd.ArrowDtype(pa.list_(pa.string())),
+    )
 
+    # Export geodataframe as csv
     gdf2export = tile_gdf.copy()
     # Convert the list of strings in 'overlapping_bursts' to a single string
-    gdf2export['overlapping_bursts'] = gdf2export['overlapping_bursts'].apply(join_lists)
-    # Ensure the geometry column is valid before applying .wkt
+    joined = pc.binary_join(pa.array(gdf2export['overlapping_bursts'].array), ',')
+    gdf2export['overlapping_bursts'] = pd.Series(pd.arrays.ArrowExtensionArray(joined), index=gdf2export.index)
+    # Ensure the geometry column is valid before converting to WKT
     if isinstance(gdf2export, gpd.GeoDataFrame) and 'geometry' in gdf2export.columns:
-        gdf2export = gdf2export[gdf2export['geometry'].notnull()]  # Remove None values
-        gdf2export = gdf2export[gdf2export['geometry'].apply(lambda x: hasattr(x, "wkt"))]  # Ensure geometry objects
+        gdf2export = gdf2export[gdf2export.geometry.notnull()]  # Remove None values
         # Convert geometry to WKT format for CSV export (suppress warning)
         with warnings.catch_warnings():
             warnings.simplefilter("ignore", UserWarning)
-            gdf2export['geometry'] = gdf2export['geometry'].apply(lambda x: x.wkt)
+            gdf2export['geometry'] = gdf2export.geometry.to_wkt()
     # Export to CSV
     gdf2export.to_csv(f"{rtc_dir}/burst_to_tile_map.csv", index=False)
 
     return tile_gdf
 
 
+@functools.lru_cache(maxsize=None)
 def get_epsg(file_path):
     with rasterio.open(file_path) as dataset:
         crs = dataset.crs
@@ -75,100 +97,110 @@ def get_epsg(file_path):
         return None
         
 
-def process_row(row, polarizations, rtc_dir, out_vrt_dir, target_crs, created_files, site, start_date, end_date):
-    if row['mask'] == 0:
-        return
-
+def process_row(row, bbox, polarizations, rtc_dir, out_vrt_dir, target_crs, target_epsg, site, start_date, end_date, num_threads=1):
+    """
+    Mosaic the bursts overlapping an active (mask == 1) tile into per-polarization COGs.
+    row is a plain dict of the tile attributes and bbox a (minx, miny, maxx, maxy)
+    tuple so that both can be pickled to worker processes.
+    num_threads is the number of GDAL threads this worker may use for the final warp.
+    """
     overlapping_names = row['overlapping_bursts']
-    bbox = row['geometry'].bounds  # [minx, miny, maxx, maxy]
     position_h = row['h']
     position_v = row['v']
-    target_epsg = CRS.from_string(target_crs).to_epsg()
 
     for pol in polarizations:
         files_2_merge = [f"{rtc_dir}/{name}_tmean_{start_date}_{end_date}_{pol}.tif" for name in overlapping_names]
-        files_2_merge = [file for file in files_2_merge if os.path.exists(file)]
+        # Absolute paths so the in-memory VRTs resolve them regardless of their location
+        files_2_merge = [os.path.abspath(file) for file in files_2_merge if os.path.exists(file)]
         
         output_tif = f'{out_vrt_dir}/s1_tile_{site}_{start_date}_{end_date}_h{str(position_h)}_v{str(position_v)}_{pol}_pre.tif'
-        output_vrt_mosaic = f'{out_vrt_dir}/s1_mosaic_{site}_{start_date}_{end_date}_h{str(position_h)}_v{str(position_v)}_{pol}.vrt'
+        output_vrt_mosaic = f'/vsimem/s1_mosaic_{site}_{start_date}_{end_date}_h{str(position_h)}_v{str(position_v)}_{pol}.vrt'
 
         reprojected_files = []
         for file in files_2_merge:
-            reprojected_file = file.replace('.tif', '_reprojected.vrt')
-
-            if reprojected_file not in created_files:
-                created_files.add(reprojected_file)
-                if not os.path.exists(reprojected_file):
-                    # Use a temporary file to ensure atomic creation
-                    with tempfile.NamedTemporaryFile(delete=False, suffix='.vrt') as temp_file:
-                        temp_path = temp_file.name
-                    try:
-                        warp_command_reproject = [
-                            'gdalwarp', '-q',
-                            '-t_srs', target_crs,
-                            '-r', 'near',
-                            '-dstnodata', 'nan',
-                            '-of', 'VRT',
-                            file, temp_path
-                        ]
-                        subprocess.run(warp_command_reproject, check=True)
-                        shutil.move(temp_path, reprojected_file)
-                    except Exception as e:
-                        # Cleanup in case of error
-                        if os.path.exists(temp_path):
-                            os.remove(temp_path)
-                        raise e
-            
+            # Sources already in the tile CRS go into the mosaic as is
+            if target_epsg is not None and get_epsg(file) == target_epsg:
+                reprojected_files.append(file)
+                continue
+
+            basename = os.path.splitext(os.path.basename(file))[0]
+            reprojected_file = f'/vsimem/{basename}.vrt'
+
+            if reprojected_file not in _created_files:
+                # /vsimem/ is private to this process, so no temporary file or rename is needed
+                ds = gdal.Warp(
+                    reprojected_file, file,
+                    format='VRT',
+                    dstSRS=target_crs,
+                    resampleAlg='near',
+                    dstNodata=float('nan'),
+                )
+                ds = None
+                _created_files.add(reprojected_file)
+
             reprojected_files.append(reprojected_file)
 
         # Build VRT mosaic
-        buildvrt_command = ['gdalbuildvrt', '-q', '-srcnodata', 'nan', '-vrtnodata', 'nan', output_vrt_mosaic] + reprojected_files
-        subprocess.run(buildvrt_command, check=True)
+        ds = gdal.BuildVRT(output_vrt_mosaic, reprojected_files, srcNodata='nan', VRTNodata='nan')
+        ds = None
 
         # Create final GeoTIFF
-        warp_command = [
-            'gdalwarp',
-            '-overwrite',
-            '-t_srs', target_crs, '-et', '0',
-            '-te', str(bbox[0]), str(bbox[1]), str(bbox[2]), str(bbox[3]),
-            '-srcnodata', 'nan', '-dstnodata', 'nan',
-            '-r', 'near',
-            '-co', 'COMPRESS=LZW',
-            '-of', 'GTiff',
-            output_vrt_mosaic,
-            output_tif,
-        ]
-        subprocess.run(warp_command, check=True)
+        ds = gdal.Warp(
+            output_tif, output_vrt_mosaic,
+            options=['-overwrite'],
+            format='GTiff',
+            dstSRS=target_crs,
+            errorThreshold=0,
+            outputBounds=bbox,
+            srcNodata=float('nan'),
+            dstNodata=float('nan'),
+            resampleAlg='near',
+            # Tiled blocks let both the warp and the LZW encoder work in parallel
+            creationOptions=['COMPRESS=LZW', f'NUM_THREADS={num_threads}', 'TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512'],
+            warpOptions=[f'NUM_THREADS={num_threads}'],
+            multithread=True,
+        )
+        ds = None
+        gdal.Unlink(output_vrt_mosaic)
 
         # Convert to Cloud Optimized GeoTIFF
-        cog_command = [
-            'gdal_translate',
-            '-of', 'COG',
-            '-co', 'COMPRESS=LZW',
-            '-co', 'BIGTIFF=IF_SAFER',
-            '-co', 'OVERVIEW_RESAMPLING=NEAREST',
-            output_tif,
+        ds = gdal.Translate(
             output_tif.replace('_pre.tif', '.tif'),  # Modify filename for COG output
-        ]
-        
-        subprocess.run(cog_command, check=True)
+            output_tif,
+            format='COG',
+            creationOptions=['COMPRESS=LZW', 'BIGTIFF=IF_SAFER', 'OVERVIEW_RESAMPLING=NEAREST'],
+        )
+        ds = None
 
 def build_opera_vrt(burst2tile_gdf, rtc_dir, site, start_date, end_date):
     # Output directory
     out_vrt_dir = f'{rtc_dir}/tile_vrts'
     os.makedirs(out_vrt_dir, exist_ok=True)
 
+    # Shared constants, resolved once for all tiles
     polarizations = ['VV', 'VH']
     target_crs = burst2tile_gdf.crs.to_string()
+    target_epsg = burst2tile_gdf.crs.to_epsg()
 
-    # Shared set for tracking created files
-    created_files = set()
+    # Only tiles with mask == 1 are processed
+    burst2tile_gdf = burst2tile_gdf[burst2tile_gdf['mask'] == 1]
 
-    # Process rows in parallel
-    with ThreadPoolExecutor() as executor:
+    # Tile attributes as lightweight records and bounds as plain tuples
+    rows = burst2tile_gdf[['h', 'v', 'overlapping_bursts']].itertuples(index=False)
+    bboxes = burst2tile_gdf.bounds.itertuples(index=False, name=None)
+
+    # Split the cores between worker processes and the GDAL threads of each worker
+    n_cpus = os.cpu_count() or 1
+    n_workers = max(1, min(n_cpus, len(burst2tile_gdf)))
+    num_threads = max(1, n_cpus // n_workers)
+
+    # Process rows in parallel across cores
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker) as executor:
         futures = [
-            executor.submit(process_row, row, polarizations, rtc_dir, out_vrt_dir, target_crs, created_files, site, start_date, end_date)
-            for _, row in burst2tile_gdf.iterrows()
+            executor.submit(process_row, row._asdict(), bbox,
+                            polarizations, rtc_dir, out_vrt_dir, target_crs, target_epsg, site, start_date, end_date,
+                            num_threads)
+            for row, bbox in zip(rows, bboxes)
         ]
         # Wait for all tasks to complete
         for future in futures:
@@ -177,45 +209,29 @@ def build_opera_vrt(burst2tile_gdf, rtc_dir, site, start_date, end_date):
 
 def check_tiles_exist(gdf, path, site, start_date, end_date):
     """
-    Check if VV and VH tile files exist for each row in the GeoDataFrame.
+    Check if VV, VH and RVI tile files exist for each row in the GeoDataFrame.
 
     Parameters:
     - gdf: GeoDataFrame with columns 'h', 'v', and 'mask'.
     - path: Path to the directory containing the tile files.
 
     Returns:
-    - A dictionary with a tuple (h, v) as the key and a dictionary indicating the existence of VV and VH tiles.
+    - 'All tiles exist' if VV, VH and RVI tiles exist for every row with mask == 1,
+      otherwise 'Tiles not found'.
     """
-    results = {}
-    all_exist = True  # Flag to track if all required tiles exist
+    # Read the directory once and check tile names against it
+    existing = {entry.name for entry in os.scandir(path)} if os.path.isdir(path) else set()
 
-    for _, row in gdf.iterrows():
-        h, v, mask = row['h'], row['v'], row['mask']
-        
-        # Tile names for VV and VH
-        vv_tile_name = f"s1_tile_{site}_{start_date}_{end_date}_h{h}_v{v}_VV.tif"
-        vh_tile_name = f"s1_tile_{site}_{start_date}_{end_date}_h{h}_v{v}_VH.tif"
-        rvi_tile_name = f"s1_tile_{site}_{start_date}_{end_date}_h{h}_v{v}_RVI.tif"
-        
-        vv_file_path = os.path.join(path, vv_tile_name)
-        vh_file_path = os.path.join(path, vh_tile_name)
-        rvi_file_path = os.path.join(path, rvi_tile_name)
-
-        if mask == 1:
-            # Check existence of both VV and VH tiles
-            vv_exists = os.path.exists(vv_file_path)
-            vh_exists = os.path.exists(vh_file_path)
-            rvi_exists = os.path.exists(rvi_file_path)
-            
-            # Store results for both tile types
-            results[(h, v)] = {'VV': vv_exists, 'VH': vh_exists, 'RVI': rvi_exists}
-
-            # Update flag if any tile is missing
-            if not (vv_exists and vh_exists and rvi_exists):
-                all_exist = False
-        else:
-            # Indicate that no tiles are expected
-            results[(h, v)] = {'VV': None, 'VH': None, 'RVI': None}
+    tile_prefix = (f"s1_tile_{site}_{start_date}_{end_date}_h" + gdf['h'].astype(str)
+                   + "_v" + gdf['v'].astype(str))
+    tiles_exist = (
+        (tile_prefix + "_VV.tif").isin(existing)
+        & (tile_prefix + "_VH.tif").isin(existing)
+        & (tile_prefix + "_RVI.tif").isin(existing)
+    )
+
+    # Only tiles with mask == 1 are expected
+    all_exist = tiles_exist[gdf['mask'] == 1].all()
 
     # Print message if all required tiles exist
     if all_exist:
@@ -238,41 +254,35 @@ def create_vrt_mosaic(path, site, start_date, end_date):
     Returns:
     - None. Creates the VRT file at the specified location.
     """
-    # Collect all .tif files ending in *VV.tif
-    vv_tile_files = [os.path.join(path, f) for f in os.listdir(path) if f.endswith("VV.tif")]
-
-    if not vv_tile_files:
-        print("No tiles found ending in *VV.tif. Mosaic not created.")
-        return
-    
-    # Build VRT mosaic
-    output_vv_vrt = f'{path}/s1_tile_mosaic_{site}_{start_date}_{end_date}_VV.vrt' 
-    vrt_options = gdal.BuildVRTOptions(resampleAlg="nearest")  # Use nearest-neighbor resampling
-    gdal.BuildVRT(output_vv_vrt, vv_tile_files, options=vrt_options)
-    print(f"VRT mosaic created successfully at: {output_vv_vrt}")
-
-    # Collect all .tif files ending in *VV.tif
-    vh_tile_files = [os.path.join(path, f) for f in os.listdir(path) if f.endswith("VH.tif")]
-
-    if not vh_tile_files:
-        print("No tiles found ending in *VH.tif. Mosaic not created.")
-        return
-    
-    # Build VRT mosaic
-    output_vh_vrt = f'{path}/s1_tile_mosaic_{site}_{start_date}_{end_date}_VH.vrt' 
-    vrt_options = gdal.BuildVRTOptions(resampleAlg="nearest")  # Use nearest-neighbor resampling
-    gdal.BuildVRT(output_vh_vrt, vh_tile_files, options=vrt_options)
-    print(f"VRT mosaic created successfully at: {output_vh_vrt}")
-
-    # Collect all .tif files ending in *RVI.tif
-    rvi_tile_files = [os.path.join(path, f) for f in os.listdir(path) if f.endswith("RVI.tif")]
-
-    if not rvi_tile_files:
-        print("No tiles found ending in *RVI.tif. Mosaic not created.")
-        return
-    
-    # Build VRT mosaic
-    output_rvi_vrt = f'{path}/s1_tile_mosaic_{site}_{start_date}_{end_date}_RVI.vrt' 
-    vrt_options = gdal.BuildVRTOptions(resampleAlg="nearest")  # Use nearest-neighbor resampling
-    gdal.BuildVRT(output_rvi_vrt, rvi_tile_files, options=vrt_options)
-    print(f"VRT mosaic created successfully at: {output_rvi_vrt}")
+    # Collect all VV, VH and RVI tiles in a single directory scan
+    vv_tile_files, vh_tile_files, rvi_tile_files = [], [], []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            name = entry.name
+            if name.endswith("VV.tif"):
+                vv_tile_files.append(entry.path)
+            elif name.endswith("VH.tif"):
+                vh_tile_files.append(entry.path)
+            elif name.endswith("RVI.tif"):
+                rvi_tile_files.append(entry.path)
+
+    # Use nearest-neighbor resampling and keep NaN as nodata
+    vrt_options = gdal.BuildVRTOptions(resampleAlg="nearest", hideNodata=False, srcNodata="nan", VRTNodata="nan")
+
+    def build_vrt(output_vrt, tile_files):
+        ds = gdal.BuildVRT(output_vrt, tile_files, options=vrt_options)
+        ds = None  # Flush VRT to disk
+
+    # Build the VRT mosaics concurrently, GDAL releases the GIL while reading tile metadata
+    futures = {}
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        for band, tile_files in [("VV", vv_tile_files), ("VH", vh_tile_files), ("RVI", rvi_tile_files)]:
+            if not tile_files:
+                print(f"No tiles found ending in *{band}.tif. Mosaic not created.")
+                continue
+            output_vrt = f'{path}/s1_tile_mosaic_{site}_{start_date}_{end_date}_{band}.vrt'
+            futures[output_vrt] = executor.submit(build_vrt, output_vrt, tile_files)
+
+    for output_vrt, future in futures.items():
+        future.result()
+        print(f"VRT mosaic created successfully at: {output_vrt}")